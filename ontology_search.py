@@ -6,187 +6,204 @@ Search ontology terms by label and synonym matching using owlready2
 
 import sys
 import argparse
-import re
 import time
+from concurrent.futures import ProcessPoolExecutor
 import nltk
-from owlready2 import get_ontology
+from owlready2 import get_ontology, label
 
+# Maximum number of tokens in n-grams searched when no exact match is found
+MAX_NGRAM_LENGTH = 7
+# Key of trie nodes holding the labels and synonyms which end at the node
+TRIE_TERMINAL = None
+TOKENIZER = nltk.tokenize.TreebankWordTokenizer()
+# Symbols to additionally split queries by in the n-gram search, translated to space
+DELIMITER_TRANS = str.maketrans('-_+/', '    ')
 
-def generate_word_combinations(text):
+
+class SearchIndex:
     """
-    Decompose input text into word combinations and generate possible combinations
-    Separators: space, underscore, hyphen, period
-    Sorted by word count (longest match first)
+    In-memory lookup tables of term labels and exact synonyms
+    Built once after loading the ontology so that each search is a dict lookup
+    instead of a quadstore query
+    Only terms satisfying additional_conditions, a frozenset of (attribute name, value) pairs, are stored
+    Terms are stored by storid, so the index can be used without owlready2 (e.g. in worker processes)
     """
-    # Split by multiple separators
-    words = re.split(r'[ _\-.]', text.strip())
-    words = [w for w in words if w]  # Remove empty strings
-    
-    combinations = []
-    
-    # Generate combinations of consecutive words
-    for length in range(len(words), 0, -1):  # From longest to shortest
-        for i in range(len(words) - length + 1):
-            combination = " ".join(words[i:i+length])
-            combinations.append(combination)
-    
-    return combinations
-
 
-def get_ngrams(text, n):
-    words = nltk.word_tokenize(text)
-    spans_gen = nltk.tokenize.TreebankWordTokenizer().span_tokenize(text)
-    spans = [span for span in spans_gen]
-    new_words = []
-    for word in words:
-        if word == "``":
-            new_words.append('"')
-        elif word == "''":
-            new_words.append('"')
-        else:
-            new_words.append(word)
-    words = new_words
+    def __init__(self, ontology, additional_conditions=frozenset()):
+        self.label_index = {}
+        self.label_lower_index = {}
+        self.exact_syn_index = {}
+        self.exact_syn_lower_index = {}
+        self.trie = {}
 
-    if not words:
-        return [], []
+        # Read labels and exact synonyms of all entities from the quadstore in one query,
+        # instead of accessing term.label and term.hasExactSynonym (a query each) term by term
+        # As with ontology.search(), all entities of the world are covered, i.e. not only classes
+        # but also individuals and properties, and entities of imported ontologies
+        # This depends on owlready2 internals, tested with owlready2 0.51 (pinned in requirements.txt):
+        # the SQLite quadstore table datas (c, s, p, o, d),
+        # and world._props, graph.db and world._get_by_storid
+        match_types = {label.storid: "label"}
+        synonym_property = ontology.world._props.get("hasExactSynonym")
+        if synonym_property is not None:
+            match_types[synonym_property.storid] = "hasExactSynonym"
+        sql = ("SELECT DISTINCT s, p, o FROM datas WHERE s > 0 AND p IN (%s)"
+               % ",".join("?" * len(match_types)))
+        cursor = ontology.graph.db.execute(sql, list(match_types))
+        
+        # Terms satisfying the additional conditions are resolved once with ontology.search(),
+        # so that its wildcards ("*") and special keys (e.g. iri, is_a) work as before
+        allowed = None
+        if additional_conditions:
+            allowed = {term.storid for term in ontology.search(**dict(additional_conditions))}
 
-    n_grams = []
-    intervals = []
-    for i in range(0, len(spans) - n + 1):
-        text_char_begin = spans[i][0]
-        text_char_end = spans[i + n - 1][1]
-        n_gram = text[text_char_begin:text_char_end]
-        n_grams.append(n_gram)
-        intervals.append((text_char_begin, text_char_end))
+        # Lowercase forms already stored for each term
+        # e.g. a label "B cell" and a synonym "b cell" of the same term are stored once
+        # Keys are interned so that lookups with interned queries compare by identity
+        lowercase_keys = set()
+        for storid, predicate, value in cursor:
+            if allowed is not None and storid not in allowed:
+                continue
+            value = sys.intern(str(value))
+            value_lower = sys.intern(value.lower())
+            is_new_lowercase = (storid, value_lower) not in lowercase_keys
+            lowercase_keys.add((storid, value_lower))
+            if match_types[predicate] == "label":
+                self.label_index.setdefault(value, []).append(storid)
+                if is_new_lowercase:
+                    self.label_lower_index.setdefault(value_lower, []).append(storid)
+                self._add_to_trie(value, value_lower, storid, "label")
+            else:
+                self.exact_syn_index.setdefault(value, []).append(storid)
+                if is_new_lowercase:
+                    self.exact_syn_lower_index.setdefault(value_lower, []).append(storid)
+                self._add_to_trie(value, value_lower, storid, "hasExactSynonym")
 
-    return n_grams, intervals
+    def _add_to_trie(self, text, text_lower, storid, match_type):
+        """
+        Store a label or synonym in the trie
+        Edges are lowercase words split by whitespace
+        """
+        node = self.trie
+        for word in text_lower.split():
+            node = node.setdefault(sys.intern(word), {})
+        node.setdefault(TRIE_TERMINAL, []).append((storid, match_type, text, text_lower))
 
 
-def delimit_words(words, delimiter):
-    delimited_words = []
-    for word in words:
-        split_words = word.split(delimiter)
-        delimited_words.extend(split_words)
-        
-        # replace delimiter to space
-        if len(split_words) != 1:
-            delimited_words.append(word.replace(delimiter, " "))
-    return
+def iter_trie_matches(trie, text, spans=None, max_n=MAX_NGRAM_LENGTH):
+    """
+    Find n-grams (up to max_n tokens) of the text which reach a terminal node of the trie
+    The trie is walked once from each token, so that n-grams are not joined and looked up one by one
+    spans are the token spans of the text, tokenized here if not given
+    Yields (n-gram, n, terminal entries), ordered by start token and then by n
+    """
+    if spans is None:
+        spans = list(TOKENIZER.span_tokenize(text))
+    words_lower = [text[begin:end].lower() for begin, end in spans]
+    for i in range(len(spans)):
+        parent = trie
+        node = None
+        word = ""
+        for j in range(i, min(i + max_n, len(spans))):
+            # Tokens not separated by whitespace (e.g. "cell" and "," of "cell,") make one edge
+            if j > i and spans[j - 1][1] != spans[j][0]:
+                if node is None:
+                    break
+                parent = node
+                word = ""
+            word += words_lower[j]
+            node = parent.get(word)
+            if node is not None and TRIE_TERMINAL in node:
+                yield text[spans[i][0]:spans[j][1]], j - i + 1, node[TRIE_TERMINAL]
 
 
-def search_ontology_term(ontology, query, additional_conditions=None):
+def search_ontology_term(index, query):
     """
     Search ontology terms that match the specified query
-    Search labels, exact synonyms, and lowercase synonyms (for case-insensitive matching)
+    Search labels, exact synonyms, and their lowercase forms (for case-insensitive matching)
+    Returns a tuple of (storid, match type, matched part, matched synonym)
     """
-    if additional_conditions is None:
-        additional_conditions = {}
-    
     all_results = []
     all_result_terms = set()
     query_lower = query.lower()
     
     # First, search for exact match (case-sensitive)
     # Search by label
-    search_kwargs = {"label": query}
-    search_kwargs.update(additional_conditions)
-    label_results = ontology.search(**search_kwargs)
-    all_results.extend([(term, "label", query, None) for term in label_results])
-    for term in label_results:
-        all_result_terms.add(term._name)
+    for storid in index.label_index.get(query, []):
+        all_results.append((storid, "label", query, None))
+        all_result_terms.add(storid)
     
     # Search by exact synonym
-    search_kwargs = {"hasExactSynonym": query}
-    search_kwargs.update(additional_conditions)
-    synonym_results = ontology.search(**search_kwargs)
-    for term in synonym_results:
-        if term._name not in all_result_terms:
-            all_results.append((term, "hasExactSynonym", query, query))
-            all_result_terms.add(term._name)
+    for storid in index.exact_syn_index.get(query, []):
+        if storid not in all_result_terms:
+            all_results.append((storid, "hasExactSynonym", query, query))
+            all_result_terms.add(storid)
     
-    # Search by lowercase synonym
-    search_kwargs = {"hasLowercaseSynonym": query_lower}
-    search_kwargs.update(additional_conditions)
-    lowercase_synonym_results = ontology.search(**search_kwargs)
-    for term in lowercase_synonym_results:
-        if term._name not in all_result_terms:
-            all_results.append((term, "hasLowercaseSynonym", query, query_lower))
-            all_result_terms.add(term._name)
+    # Search by lowercase label and synonym
+    lowercase_results = (index.label_lower_index.get(query_lower, [])
+                         + index.exact_syn_lower_index.get(query_lower, []))
+    for storid in lowercase_results:
+        if storid not in all_result_terms:
+            all_results.append((storid, "hasLowercaseSynonym", query, query_lower))
+            all_result_terms.add(storid)
     
     # Return if exact match found
     if all_results:
-        return all_results
+        return tuple(all_results)
     
-    # If no exact match, search with word decomposition (longest match first)
-    word_combinations = []
-    word_combinations_set = set()
-    grams, intervals = get_ngrams(query, 1)
-    max_n = min(7, len(grams))
-    for n in reversed(range(1, max_n+1)):
-        grams, intervals = get_ngrams(query, n)
-        for gram in grams:
-            word_combinations.append((gram, n))
-            word_combinations_set.add(gram)
-    
-    delimited_query = " ".join(re.split('[-_+/]', query))
-    grams, intervals = get_ngrams(delimited_query, 1)
-    max_n = min(7, len(grams))
-    for n in reversed(range(1, max_n+1)):
-        grams, intervals = get_ngrams(delimited_query, n)
-        for gram in grams:
-            if gram not in word_combinations_set:
-                word_combinations.append((gram, n))
-                word_combinations_set.add(gram)
-
-    # Group by word count
-    ## e.g. {3: ["a b c"], 2: ["a b", "b c"], 1:["a", "b", "c"]}
-    combinations_by_length = {}
-    for combination in word_combinations:
-        word_count = combination[1]
-        if word_count not in combinations_by_length:
-            combinations_by_length[word_count] = []
-        combinations_by_length[word_count].append(combination[0])
+    # A single token query has no n-grams other than itself, which is already searched above
+    spans = list(TOKENIZER.span_tokenize(query))
+    delimited_query = query.translate(DELIMITER_TRANS)
+    if (not spans or spans == [(0, len(query))]) and delimited_query == query:
+        return ()
     
-    # Search from longest to shortest word count
-    for word_count in sorted(combinations_by_length.keys(), reverse=True):
-        current_results = []
-        current_result_terms = set()
-        
-        for combination in combinations_by_length[word_count]:
+    # If no exact match, search with word decomposition (longest match first)
+    # n-grams of the query, and then of the query split also by [-_+/], are matched against the trie
+    # results_by_length maps word count to (results, storids of the results, current_seen)
+    results_by_length = {}
+    searched_combinations = set()
+    for is_delimited, (text, text_spans) in enumerate(((query, spans), (delimited_query, None))):
+        for combination, word_count, entries in iter_trie_matches(index.trie, text, text_spans):
+            if is_delimited and combination in searched_combinations:
+                continue
+            searched_combinations.add(combination)
+            
+            if word_count not in results_by_length:
+                results_by_length[word_count] = ([], set(), set())
+            # current_seen holds (storid, match type, matched part) of the results
+            # so that a combination repeated in the query (e.g. "cell cell") is output once
+            current_results, current_result_terms, current_seen = results_by_length[word_count]
             combination_lower = combination.lower()
+            label_entries = [entry for entry in entries if entry[1] == "label"]
+            synonym_entries = [entry for entry in entries if entry[1] == "hasExactSynonym"]
             
             # Search by label (case-sensitive)
-            search_kwargs = {"label": combination}
-            search_kwargs.update(additional_conditions)
-            label_results = ontology.search(**search_kwargs)
-            current_results.extend([(term, "label", combination, None) for term in label_results])
-            for term in label_results:
-                current_result_terms.add(term._name)
+            for storid, _, original, _ in label_entries:
+                key = (storid, "label", combination)
+                if original == combination and key not in current_seen:
+                    current_results.append((storid, "label", combination, None))
+                    current_result_terms.add(storid)
+                    current_seen.add(key)
 
             # Search by exact synonym (case-sensitive)
-            search_kwargs = {"hasExactSynonym": combination}
-            search_kwargs.update(additional_conditions)
-            synonym_results = ontology.search(**search_kwargs)
-            for term in synonym_results:
-                if term._name not in current_result_terms:
-                    current_results.append((term, "hasExactSynonym", combination, combination))
-                    current_result_terms.add(term._name)
+            for storid, _, original, _ in synonym_entries:
+                if original == combination and storid not in current_result_terms:
+                    current_results.append((storid, "hasExactSynonym", combination, combination))
+                    current_result_terms.add(storid)
             
-            # Search by lowercase synonym
-            search_kwargs = {"hasLowercaseSynonym": combination_lower}
-            search_kwargs.update(additional_conditions)
-            lowercase_synonym_results = ontology.search(**search_kwargs)
-            
-            for term in lowercase_synonym_results:
-                if term._name not in current_result_terms:
-                    current_results.append((term, "hasLowercaseSynonym", combination, combination))
-                    current_result_terms.add(term._name)
-        
-        # If matches found for this word count, don't search shorter combinations
-        if current_results:
-            return current_results
+            # Search by lowercase label and synonym
+            for storid, _, _, original_lower in label_entries + synonym_entries:
+                if original_lower == combination_lower and storid not in current_result_terms:
+                    current_results.append((storid, "hasLowercaseSynonym", combination, combination))
+                    current_result_terms.add(storid)
+    
+    # Return matches of the longest word count found
+    # Shorter combinations are not used if longer ones match
+    for word_count in range(MAX_NGRAM_LENGTH, 0, -1):
+        if word_count in results_by_length and results_by_length[word_count][0]:
+            return tuple(results_by_length[word_count][0])
     
-    return []
+    return ()
 
 
 def parse_additional_conditions(condition_str):
@@ -216,9 +233,57 @@ def get_term_label(term):
     """
     Get the label of an ontology term
     """
-    if hasattr(term, 'label') and term.label:
-        return term.label[0] if isinstance(term.label, list) else str(term.label)
-    return getattr(term, 'name', str(term).split('#')[-1].split('/')[-1])
+    # label is not functional, so owlready2 always gives a list
+    labels = getattr(term, 'label', None)
+    if labels:
+        return labels[0]
+    return get_term_id(term)
+
+
+def get_term_id(term):
+    """
+    Get the ID of an ontology term
+    The ID is taken from the IRI only when the term has no name
+    """
+    name = getattr(term, 'name', None)
+    if name:
+        return name
+    return str(term).rpartition('#')[2].rpartition('/')[2]
+
+
+# Search index of a worker process, set by init_search_worker
+worker_index = None
+
+
+def init_search_worker(index):
+    """
+    Initialize a worker process with the search index
+    """
+    global worker_index
+    worker_index = index
+
+
+def search_in_worker(query):
+    """
+    Search ontology terms with the search index of the worker process
+    """
+    return search_ontology_term(worker_index, query)
+
+
+def iter_search_results(index, queries, jobs=1):
+    """
+    Search ontology terms for each query and yield the results in the order of queries
+    When jobs > 1, queries are searched in parallel by worker processes
+    which only need the search index, not the ontology
+    """
+    if jobs <= 1:
+        for query in queries:
+            yield search_ontology_term(index, query)
+        return
+    
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_search_worker,
+                             initargs=(index,)) as executor:
+        yield from executor.map(search_in_worker, queries, chunksize=256)
 
 
 def main():
@@ -227,14 +292,16 @@ def main():
     parser.add_argument('query_file', help='Path to text file containing queries')
     parser.add_argument('--condition', '-c', 
                        help='Additional search condition (e.g., hasDbXref:NCBI_TaxID:9606)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                       help='Number of worker processes for the search (default: 1)')
     
     args = parser.parse_args()
     
     try:
         # Parse additional conditions
-        additional_conditions = {}
+        additional_conditions = frozenset()
         if args.condition:
-            additional_conditions = parse_additional_conditions(args.condition)
+            additional_conditions = frozenset(parse_additional_conditions(args.condition).items())
         
         # Load ontology with timing
         print("Loading ontology...", file=sys.stderr)
@@ -243,34 +310,54 @@ def main():
         load_time = time.time() - start_time
         print(f"Ontology loaded in {load_time:.2f} seconds", file=sys.stderr)
         
+        # Build label/synonym lookup tables with timing
+        print("Building search index...", file=sys.stderr)
+        start_time = time.time()
+        index = SearchIndex(ontology, additional_conditions)
+        index_time = time.time() - start_time
+        print(f"Search index built in {index_time:.2f} seconds", file=sys.stderr)
+        
+        # Write results block-buffered even to a terminal, one write per query
+        out = sys.stdout
+        out.reconfigure(line_buffering=False)
+        
         # Output header (TSV format)
-        print("Query\tMatchedPart\tTermID\tMatchType\tTermLabel\tMatchedSynonym")
+        out.write("Query\tMatchedPart\tTermID\tMatchType\tTermLabel\tMatchedSynonym\n")
         
         # Read query file and process each line
         print("Starting term search...", file=sys.stderr)
         search_start_time = time.time()
         
         with open(args.query_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                query = line.strip()
-                if not query:  # Skip empty lines
-                    continue
-                
-                # Search ontology terms
-                term_results = search_ontology_term(ontology, query, additional_conditions)
-                
-                # Output results in TSV format
-                if term_results:
-                    for term, match_type, matched_part, matched_synonym in term_results:
-                        # Get term ID
-                        term_id = getattr(term, 'name', str(term).split('#')[-1].split('/')[-1])
-                        # Get term label
-                        term_label = get_term_label(term)
-                        # Prepare synonym column
-                        synonym_col = matched_synonym if matched_synonym else ""
-                        print(f"{query}\t{matched_part}\t{term_id}\t{match_type}\t{term_label}\t{synonym_col}")
-                else:
-                    print(f"{query}\t\t\t\t\t")
+            # Split only by newlines: str.splitlines() also splits by e.g. \x0c and \x85
+            queries = [sys.intern(line.strip()) for line in f.read().split("\n")]
+        queries = [query for query in queries if query]  # Skip empty lines
+        
+        # Term ID and label of each matched term, so that a term is read from the quadstore only once
+        term_columns = {}
+        
+        # Search ontology terms
+        # Duplicate queries are searched only once
+        unique_queries = list(dict.fromkeys(queries))
+        results_by_query = dict(zip(unique_queries, iter_search_results(index, unique_queries, args.jobs)))
+        for query in queries:
+            term_results = results_by_query[query]
+            # Output results in TSV format
+            rows = []
+            if term_results:
+                for storid, match_type, matched_part, matched_synonym in term_results:
+                    if storid not in term_columns:
+                        term = ontology.world._get_by_storid(storid)
+                        # Get term ID and label
+                        term_columns[storid] = (get_term_id(term), get_term_label(term))
+                    term_id, term_label = term_columns[storid]
+                    # Prepare synonym column
+                    synonym_col = matched_synonym if matched_synonym else ""
+                    rows.append(f"{query}\t{matched_part}\t{term_id}\t{match_type}\t{term_label}\t{synonym_col}")
+            else:
+                rows.append(f"{query}\t\t\t\t\t")
+            out.write("\n".join(rows) + "\n")
+        out.flush()
         
         search_time = time.time() - search_start_time
         print(f"Search completed in {search_time:.2f} seconds", file=sys.stderr)